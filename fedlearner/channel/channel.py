@@ -134,6 +134,7 @@ class Channel():
                  compression=grpc.Compression.Gzip,
                  heartbeat_timeout=120,
                  retry_interval=2,
+                 options=None,
                  stats_client=None):
         # identifier
         self._identifier = uuid.uuid4().hex[:16]
@@ -173,6 +174,9 @@ class Channel():
         self._error = None
         self._event_callbacks = {}
 
+        # extra grpc options for both client channel and server
+        options = tuple(options) if options else ()
+
         # channel
         self._remote_address = remote_address
         self._channel = make_insecure_channel(
@@ -182,7 +186,7 @@ class Channel():
                 ('grpc.max_send_message_length', -1),
                 ('grpc.max_receive_message_length', -1),
                 ('grpc.max_reconnect_backoff_ms', 1000),
-            ),
+            ) + options,
             compression=compression
         )
         self._channel_interceptor = ClientInterceptor(
@@ -204,7 +208,7 @@ class Channel():
             options=(
                 ('grpc.max_send_message_length', -1),
                 ('grpc.max_receive_message_length', -1),
-            ),
+            ) + options,
             interceptors=(self._server_interceptor,),
             compression=compression)
         self._server.add_insecure_port(self._listen_address)
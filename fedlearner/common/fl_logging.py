@@ -68,6 +68,9 @@ def set_level(level):
         raise ValueError("Unknow log level: %s"%level)
     _logger.setLevel(level_)
 
+def is_debug_enabled():
+    return _logger.isEnabledFor(_logging.DEBUG)
+
 critical = _logger.critical
 fatal = _logger.critical
 error = _logger.error
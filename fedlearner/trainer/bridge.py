@@ -17,10 +17,13 @@
 
 import os
 import collections
+import queue
 import threading
 import time
 from distutils.util import strtobool
 
+import grpc
+import numpy as np
 import tensorflow.compat.v1 as tf
 from google.protobuf import any_pb2 as any_pb
 from fedlearner.common import fl_logging
@@ -33,6 +36,23 @@ from fedlearner.trainer._global_context import global_context as _gctx
 _BRIDGE_SUPERVISE_ENABLED = strtobool(
     os.getenv("FL_BRIDGE_SUPERVISE_ENABLED", "false"))
 
+# marks the end of transmit stream queue
+_STREAM_END = object()
+# asks stream transmit to send pending messages without waiting
+_STREAM_FLUSH = object()
+
+# Let http2 coalesce small stream writes into larger frames. A bigger
+# write buffer raises throughput of many small sends per iteration at
+# the cost of a few microseconds latency per message.
+_CHANNEL_OPTIONS = (
+    ('grpc.http2.write_buffer_size', 1 << 20),
+    ('grpc.http2.max_frame_size', 4 * 1024 * 1024),
+    ('grpc.http2.bdp_probe', 1),
+    # options go to both client and server, let the server accept
+    # keepalive pings on the long-lived streams while they are idle
+    ('grpc.keepalive_permit_without_calls', 1),
+)
+
 class Bridge(object):
     class TrainerWorkerServicer(tws2_grpc.TrainerWorkerServiceServicer):
         def __init__(self, bridge):
@@ -43,9 +63,19 @@ class Bridge(object):
             for request in request_iterator:
                 yield self._bridge._transmit_handler(request)
 
+        def StreamTransmit(self, request_iterator, context):
+            # responses are tiny acks, not worth compressing
+            context.set_compression(grpc.Compression.NoCompression)
+            for request in request_iterator:
+                yield self._bridge._transmit_batch_handler(request)
+
         def LoadDataBlock(self, request, context):
             return self._bridge._data_block_handler(request)
 
+        def LoadDataBlocks(self, request_iterator, context):
+            for request in request_iterator:
+                yield self._bridge._data_block_handler(request)
+
     def __init__(self,
                  role,
                  listen_port,
@@ -53,7 +83,11 @@ class Bridge(object):
                  app_id=None,
                  worker_rank=0,
                  stream_queue_size=1024,
-                 waiting_alert_timeout=10):
+                 stream_batch_size=64,
+                 stream_batch_window=0.001,
+                 waiting_alert_timeout=10,
+                 enable_compression=True,
+                 dtype_policy='fp32'):
         self._role = role
         self._listen_address = "[::]:{}".format(listen_port)
         self._remote_address = remote_address
@@ -67,30 +101,71 @@ class Bridge(object):
         self._terminated = False
         self._peer_terminated = False
 
+        # guards iter state below, so that start/send/commit don't contend
+        # with received data handling on self._condition. lock order:
+        # self._iter_lock -> self._condition
+        self._iter_lock = threading.RLock()
         self._current_iter_id = None
         self._next_iter_id = 0
+        # start is sent along with the first message of the iter
+        self._pending_start = False
         self._iter_started_at = 0
         self._peer_start_iter_id = None
         self._peer_commit_iter_id = None
 
-        self._received_data = collections.defaultdict(dict)
+        # (iter_id, name) -> DataMessage
+        self._received_data = {}
+        # (iter_id, name) -> threading.Event, set when the data arrives
+        # or when the waiting receiver should give up
+        self._data_events = {}
         self._data_block_handler_fn = None
+        # LoadDataBlocks stream, responses come back in request order.
+        # queue and thread are replaced when the stream fails
+        self._data_block_lock = threading.Lock()
+        self._data_block_queue = None
+        self._data_block_waiters = collections.deque()
+        self._data_block_thread = None
+
+        # wire format of float32 tensors, must be the same as peer's
+        if dtype_policy not in ('fp32', 'bf16', 'int8'):
+            raise ValueError(
+                "[Bridge] unknown dtype_policy: {}".format(dtype_policy))
+        self._dtype_policy = dtype_policy
 
         self._waiting_alert_timeout = waiting_alert_timeout
         if self._waiting_alert_timeout < 1:
             self._waiting_alert_timeout = 1
 
         # transmit stream queue
-        self._stream_queue = collections.deque()
-        self._stream_queue_size = stream_queue_size
+        self._stream_queue = queue.Queue(maxsize=stream_queue_size)
+        self._stream_batch_size = max(stream_batch_size, 1)
+        self._stream_batch_window = stream_batch_window
         self._stream_thread = None
-        self._stream_condition = threading.Condition()
         self._stream_terminated = False
 
+        # responses never change, share them. they are only read when
+        # serialized, so safe to reuse across threads
+        self._transmit_ok_response = tws2_pb.TransmitResponse(
+            status=common_pb.Status(code=common_pb.STATUS_SUCCESS))
+        self._data_block_ok_response = tws2_pb.LoadDataBlockResponse(
+            status=common_pb.Status(code=common_pb.STATUS_SUCCESS))
+        self._data_block_invalid_response = tws2_pb.LoadDataBlockResponse(
+            status=common_pb.Status(code=common_pb.STATUS_INVALID_DATA_BLOCK))
+
+        # TransmitRequest.msg oneof field -> handler
+        self._request_handlers = {
+            "start": self._handle_start_request,
+            "data": self._handle_data_request,
+            "commit": self._handle_commit_request,
+        }
+
         # channel
         self._channel = Channel(
             self._listen_address, self._remote_address,
             token=self._token,
+            options=_CHANNEL_OPTIONS,
+            compression=grpc.Compression.Gzip if enable_compression \
+                else grpc.Compression.NoCompression,
             stats_client=_gctx.stats_client)
         self._channel.subscribe(self._channel_callback)
 
@@ -108,7 +183,7 @@ class Bridge(object):
         if event == Channel.Event.PEER_CLOSED:
             with self._condition:
                 self._peer_terminated = True
-                self._condition.notify_all()
+                self._set_data_events()
         if event == Channel.Event.ERROR:
             err = channel.error()
             fl_logging.fatal("[Bridge] suicide as channel exception: %s, "
@@ -140,15 +215,15 @@ class Bridge(object):
         return self._channel.closed_at
 
     def _check_iteration_timeout(self):
-        with self._condition:
-            if self._current_iter_id is None:
-                return
-            duration = time.time() - self._iter_started_at
-            if duration >= self._supervise_iteration_timeout:
-                msg = "Suicide as iter run timeout, duration: {}, " \
-                      "maybe blocked in some point.".format(duration)
-                fl_logging.fatal(msg)
-                os._exit(138)
+        # no lock, a blocked iteration may be holding self._iter_lock
+        if self._current_iter_id is None:
+            return
+        duration = time.time() - self._iter_started_at
+        if duration >= self._supervise_iteration_timeout:
+            msg = "Suicide as iter run timeout, duration: {}, " \
+                  "maybe blocked in some point.".format(duration)
+            fl_logging.fatal(msg)
+            os._exit(138)
 
     def _supervise_fn(self):
         check_handlers = []
@@ -183,148 +258,280 @@ class Bridge(object):
             self._supervise_thread.start()
 
     def terminate(self):
-        with self._condition:
-            if not self._connected:
-                return
-            if self._terminated:
-                return
+        with self._iter_lock:
+            with self._condition:
+                if not self._connected:
+                    return
+                if self._terminated:
+                    return
 
             if self._is_iter_started:
                 self.commit()
 
-            self._terminated = True
-            self._condition.notify_all()
-            with self._stream_condition:
+            with self._condition:
+                self._terminated = True
+                self._condition.notify_all()
                 self._stream_terminated = True
-                self._stream_condition.notify_all()
+        self._stream_queue.put(_STREAM_END)
         self._stream_transmit_thread.join()
+        with self._data_block_lock:
+            data_block_thread = self._data_block_thread
+            if data_block_thread is not None:
+                self._data_block_queue.put(_STREAM_END)
+        if data_block_thread is not None:
+            data_block_thread.join()
         self._channel.close()
 
     def _stream_transmit_fn(self):
         IDLE_TIMEOUT = 30
         fl_logging.debug("[Bridge] stream transmit started")
+        stream_closed = False
 
-        def request_iterator():
+        def request_iterator(head):
+            nonlocal stream_closed
             fl_logging.debug("[Bridge] stream transmitting")
+            items = [head]
             while True:
-                with self._stream_condition:
-                    if len(self._stream_queue) == 0:
-                        start = time.time()
-                        while len(self._stream_queue) == 0:
-                            duration = time.time() - start
-                            if self._stream_terminated:
-                                return
-                            if duration >= IDLE_TIMEOUT:
-                                fl_logging.debug("[Bridge] stream transmit "
-                                   " closed by idle timeout: %f sec",
-                                   IDLE_TIMEOUT)
-                                return
-                            self._stream_condition.wait(IDLE_TIMEOUT-duration)
-                    msg = self._stream_queue.popleft()
-                    self._stream_condition.notify_all()
-                yield msg
-
-        while True:
-            with self._stream_condition:
-                while len(self._stream_queue) == 0:
-                    if self._stream_terminated:
-                        fl_logging.debug("[Bridge] stream transmit closed")
-                        return
-                    self._stream_condition.wait()
+                marker = self._stream_drain(items)
+                # wait a short window to coalesce small messages
+                deadline = time.time() + self._stream_batch_window
+                while marker is None \
+                    and len(items) < self._stream_batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        msg = self._stream_queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if msg is _STREAM_FLUSH or msg is _STREAM_END:
+                        marker = msg
+                        break
+                    items.append(msg)
+                    marker = self._stream_drain(items)
+                if marker is _STREAM_END:
+                    stream_closed = True
+                if items:
+                    batch = tws2_pb.TransmitBatch()
+                    for item in items:
+                        self._fill_request(batch.items.add(), item)
+                    yield batch
+                if stream_closed:
+                    return
+                try:
+                    head = self._stream_queue.get(timeout=IDLE_TIMEOUT)
+                except queue.Empty:
+                    fl_logging.debug("[Bridge] stream transmit "
+                       " closed by idle timeout: %f sec",
+                       IDLE_TIMEOUT)
+                    return
+                if head is _STREAM_END:
+                    stream_closed = True
+                    return
+                items = [] if head is _STREAM_FLUSH else [head]
+
+        while not stream_closed:
+            head = self._stream_queue.get()
+            if head is _STREAM_END:
+                break
+            if head is _STREAM_FLUSH:
+                continue
             response_iterator = \
-                self._client.Transmit(request_iterator())
+                self._client.StreamTransmit(request_iterator(head))
             for _ in response_iterator:
                 pass
-
-    def _transmit(self, msg):
-        with self._stream_condition:
-            assert not self._stream_terminated
-            while len(self._stream_queue) == self._stream_queue_size:
-                fl_logging.warning("[Bridge] transmit stream queue is full, "
-                                   "size: %d", len(self._stream_queue))
-                self._stream_condition.wait()
-            self._stream_queue.append(msg)
-            self._stream_condition.notify_all()
+        fl_logging.debug("[Bridge] stream transmit closed")
+
+    def _stream_drain(self, items):
+        # move already queued messages into items without waiting, up to
+        # batch size. return end/flush marker if met, or None.
+        # safe as the stream transmit thread is the only consumer, so
+        # the qsize snapshot can only grow until we get them all
+        count = min(self._stream_queue.qsize(),
+                    self._stream_batch_size - len(items))
+        for _ in range(count):
+            msg = self._stream_queue.get(block=False)
+            if msg is _STREAM_FLUSH or msg is _STREAM_END:
+                return msg
+            items.append(msg)
+        return None
+
+    def flush(self):
+        # send out queued messages without waiting for batch window
+        self._stream_queue.put(_STREAM_FLUSH)
+
+    def _fill_request(self, req, item):
+        # build message in place in the batch. deferred tensor is
+        # serialized here, overlapping with network write of previous
+        # batch
+        iter_id, name, start_flag, commit_flag, payload = item
+        data = req.data
+        data.iter_id = iter_id
+        if start_flag:
+            data.start_flag = True
+        if commit_flag:
+            data.commit_flag = True
+        if payload is None:
+            return
+        data.name = name
+        if isinstance(payload, tuple):
+            data.tensor_bytes, scale = payload
+            if scale:
+                data.scale = scale
+        elif isinstance(payload, any_pb.Any):
+            data.any_data.CopyFrom(payload)
+        else:
+            try:
+                x, scale = self._quantize_ndarray(payload)
+                data.tensor_bytes = \
+                    tf.make_tensor_proto(x).SerializeToString()
+                if scale:
+                    data.scale = scale
+            except Exception as e:  # pylint: disable=broad-except
+                # drop the data but keep the stream and start/commit
+                # flags, receiver fails with peer committed without
+                # sending data
+                fl_logging.error("[Bridge] failed to serialize iter_id: %d, "
+                                 "name: %s, error: %s",
+                                 iter_id, name, repr(e))
+                data.ClearField('name')
+                data.ClearField('tensor_bytes')
+                data.ClearField('scale')
+
+    def _transmit(self, item):
+        # item: (iter_id, name, start_flag, commit_flag, payload), payload
+        # is None, (tensor_bytes, scale), any_pb.Any or numpy array to be
+        # serialized by stream transmit thread
+        assert not self._stream_terminated
+        try:
+            self._stream_queue.put_nowait(item)
+        except queue.Full:
+            fl_logging.warning("[Bridge] transmit stream queue is full, "
+                               "size: %d", self._stream_queue.qsize())
+            self._stream_queue.put(item)
 
     def _transmit_handler(self, request):
         with self._condition:
-            if request.HasField("start"):
-                if self._peer_commit_iter_id is not None \
-                    and request.start.iter_id <= self._peer_commit_iter_id:
-                    fl_logging.warning(
-                        "[Bridge] received peer start iter_id: %d "
-                        "which has been committed. "
-                        "maybe caused by resend.(peer_commit_iter_id: %d)",
-                        request.start.iter_id, self._peer_commit_iter_id)
-                elif self._peer_start_iter_id is not None:
-                    fl_logging.warning(
-                        "[Bridge] received repeated peer start iter_id: %d. "
-                        "maybe caused by resend.(peer_start_iter_id: %d)",
-                        request.start.iter_id, self._peer_start_iter_id)
-                else:
-                    fl_logging.debug("[Bridge] received peer start iter_id: %d",
-                                     request.start.iter_id)
-                    self._peer_start_iter_id = request.start.iter_id
-                    self._condition.notify_all()
-
-            elif request.HasField("data"):
-                if self._peer_start_iter_id is None:
-                    fl_logging.warning(
-                        "[Bridge] received data iter_id: %d without start. "
-                        "maybe caused by resend.",
-                        request.data.iter_id)
-                elif self._peer_start_iter_id != request.data.iter_id:
-                    fl_logging.warning(
-                        "[Bridge] received data iter_id: %d no match start. "
-                        "maybe caused by resend.(peer_start_iter_id: %d)",
-                        request.data.iter_id, self._peer_start_iter_id)
-                else:
-                    iter_id = self._current_iter_id \
-                        if self._current_iter_id is not None \
-                            else self._next_iter_id
-                    if request.data.iter_id < iter_id:
-                        fl_logging.debug("[Bridge] received data iter_id: %d, "
-                            "name: %s, ignored by our commit."
-                            "(current_iter_id: %s, next_iter_id: %d)",
-                            request.data.iter_id, request.data.name,
-                            self._current_iter_id, self._next_iter_id)
-                    else:
-                        fl_logging.debug("[Bridge] received data iter_id: %d, "
-                            "name: %s",
-                            request.data.iter_id, request.data.name)
-                        self._received_data[ \
-                            request.data.iter_id][ \
-                                request.data.name] = request.data
-                        self._condition.notify_all()
-
-            elif request.HasField("commit"):
-                if self._peer_commit_iter_id is not None \
-                    and request.commit.iter_id <= self._peer_commit_iter_id:
-                    fl_logging.warning(
-                        "[Bridge] receive repeated peer commit iter_id: %d. "
-                        "maybe caused by resend.(peer_commit_iter_id: %d)",
-                        request.commit.iter_id, self._peer_commit_iter_id)
-                elif self._peer_start_iter_id is None:
-                    fl_logging.error(
-                        "[Bridge] receive peer commit iter_id: %d "
-                        "without start",
-                        request.commit.iter_id)
-                    # return error?
-                elif request.commit.iter_id != self._peer_start_iter_id:
-                    fl_logging.error(
-                        "[Bridge] receive peer commit iter_id: %s "
-                        "no match start.(peer_start_iter_id: %d)",
-                        request.commit.iter_id, self._peer_start_iter_id)
-                    # return error?
-                else:
-                    fl_logging.debug("[Bridge] receive peer commit iter_id: %d",
-                        request.commit.iter_id)
-                    self._peer_start_iter_id = None
-                    self._peer_commit_iter_id = request.commit.iter_id
-                    self._condition.notify_all()
-
-        return tws2_pb.TransmitResponse(
-            status=common_pb.Status(code=common_pb.STATUS_SUCCESS))
+            self._dispatch_request(request)
+
+        return self._transmit_ok_response
+
+    def _dispatch_request(self, request):
+        handler = self._request_handlers.get(request.WhichOneof("msg"))
+        if handler is not None:
+            handler(request)
+
+    def _handle_start_request(self, request):
+        self._handle_start(request.start.iter_id)
+
+    def _handle_data_request(self, request):
+        data = request.data
+        if data.start_flag:
+            self._handle_start(data.iter_id)
+        if data.name:
+            self._handle_data(data)
+        if data.commit_flag:
+            self._handle_commit(data.iter_id)
+
+    def _handle_commit_request(self, request):
+        self._handle_commit(request.commit.iter_id)
+
+    def _handle_start(self, iter_id):
+        if self._peer_commit_iter_id is not None \
+            and iter_id <= self._peer_commit_iter_id:
+            fl_logging.warning(
+                "[Bridge] received peer start iter_id: %d "
+                "which has been committed. "
+                "maybe caused by resend.(peer_commit_iter_id: %d)",
+                iter_id, self._peer_commit_iter_id)
+        elif self._peer_start_iter_id is not None:
+            fl_logging.warning(
+                "[Bridge] received repeated peer start iter_id: %d. "
+                "maybe caused by resend.(peer_start_iter_id: %d)",
+                iter_id, self._peer_start_iter_id)
+        else:
+            if fl_logging.is_debug_enabled():
+                fl_logging.debug("[Bridge] received peer start iter_id: %d",
+                                 iter_id)
+            self._peer_start_iter_id = iter_id
+
+    def _handle_data(self, data):
+        if self._peer_start_iter_id is None:
+            fl_logging.warning(
+                "[Bridge] received data iter_id: %d without start. "
+                "maybe caused by resend.",
+                data.iter_id)
+        elif self._peer_start_iter_id != data.iter_id:
+            fl_logging.warning(
+                "[Bridge] received data iter_id: %d no match start. "
+                "maybe caused by resend.(peer_start_iter_id: %d)",
+                data.iter_id, self._peer_start_iter_id)
+        else:
+            # iter state is written under self._iter_lock only. snapshot
+            # next before current: start() sets current before advancing
+            # next and commit() only clears current, so no interleaving
+            # yields an iter past the one we are in
+            next_iter_id = self._next_iter_id
+            current_iter_id = self._current_iter_id
+            iter_id = current_iter_id \
+                if current_iter_id is not None else next_iter_id
+            if data.iter_id < iter_id:
+                if fl_logging.is_debug_enabled():
+                    fl_logging.debug("[Bridge] received data iter_id: %d, "
+                        "name: %s, ignored by our commit."
+                        "(current_iter_id: %s, next_iter_id: %d)",
+                        data.iter_id, data.name,
+                        current_iter_id, next_iter_id)
+            else:
+                if fl_logging.is_debug_enabled():
+                    fl_logging.debug("[Bridge] received data iter_id: %d, "
+                        "name: %s",
+                        data.iter_id, data.name)
+                key = (data.iter_id, data.name)
+                self._received_data[key] = data
+                event = self._data_events.get(key)
+                if event is not None:
+                    event.set()
+
+    def _handle_commit(self, iter_id):
+        if self._peer_commit_iter_id is not None \
+            and iter_id <= self._peer_commit_iter_id:
+            fl_logging.warning(
+                "[Bridge] receive repeated peer commit iter_id: %d. "
+                "maybe caused by resend.(peer_commit_iter_id: %d)",
+                iter_id, self._peer_commit_iter_id)
+        elif self._peer_start_iter_id is None:
+            fl_logging.error(
+                "[Bridge] receive peer commit iter_id: %d "
+                "without start",
+                iter_id)
+            # return error?
+        elif iter_id != self._peer_start_iter_id:
+            fl_logging.error(
+                "[Bridge] receive peer commit iter_id: %s "
+                "no match start.(peer_start_iter_id: %d)",
+                iter_id, self._peer_start_iter_id)
+            # return error?
+        else:
+            if fl_logging.is_debug_enabled():
+                fl_logging.debug("[Bridge] receive peer commit iter_id: %d",
+                    iter_id)
+            self._peer_start_iter_id = None
+            self._peer_commit_iter_id = iter_id
+            self._set_data_events(self._peer_commit_iter_id)
+
+    def _set_data_events(self, max_iter_id=None):
+        # wake up receivers waiting on iter_id <= max_iter_id, or all
+        # receivers if max_iter_id is None
+        for (iter_id, _), event in self._data_events.items():
+            if max_iter_id is None or iter_id <= max_iter_id:
+                event.set()
+
+    def _transmit_batch_handler(self, request):
+        with self._condition:
+            for item in request.items:
+                self._dispatch_request(item)
+        return self._transmit_ok_response
 
     def _data_block_handler(self, request):
         assert self._data_block_handler_fn is not None, \
@@ -332,14 +539,10 @@ class Bridge(object):
         if self._data_block_handler_fn(request):
             fl_logging.info("[Bridge] succeeded to load data block %s",
                          request.block_id)
-            return tws2_pb.LoadDataBlockResponse(
-                status=common_pb.Status(code=common_pb.STATUS_SUCCESS)
-            )
+            return self._data_block_ok_response
         fl_logging.info("[Bridge] failed to load data block %s",
                         request.block_id)
-        return tws2_pb.LoadDataBlockResponse(
-            status=common_pb.Status(code=common_pb.STATUS_INVALID_DATA_BLOCK)
-        )
+        return self._data_block_invalid_response
 
     @property
     def _is_iter_started(self):
@@ -366,36 +569,39 @@ class Bridge(object):
             raise RuntimeError("[Bridge] last started not commit yet")
 
     def start(self):
-        with self._condition:
+        with self._iter_lock:
             self._assert_iter_committed()
 
             self._current_iter_id = self._next_iter_id
             self._next_iter_id += 1
             self._iter_started_at = time.time()
-            self._transmit(tws2_pb.TransmitRequest(
-                start=tws2_pb.TransmitRequest.StartMessage(
-                    iter_id=self._current_iter_id)
-            ))
-            fl_logging.debug("[Bridge] send start iter_id: %d",
-                self._current_iter_id)
+            self._pending_start = True
+            if fl_logging.is_debug_enabled():
+                fl_logging.debug("[Bridge] send start iter_id: %d",
+                    self._current_iter_id)
 
     def commit(self):
-        with self._condition:
+        with self._iter_lock:
             self._assert_iter_started()
 
-            self._transmit(tws2_pb.TransmitRequest(
-                commit=tws2_pb.TransmitRequest.CommitMessage(
-                    iter_id=self._current_iter_id)
-            ))
-            fl_logging.debug("[Bridge] send commit iter_id: %d",
-                self._current_iter_id)
-            # delete committed data
-            if self._current_iter_id in self._received_data:
-                del self._received_data[self._current_iter_id]
+            self._transmit((self._current_iter_id, '',
+                            self._pending_start, True, None))
+            self._pending_start = False
+            if fl_logging.is_debug_enabled():
+                fl_logging.debug("[Bridge] send commit iter_id: %d",
+                    self._current_iter_id)
             iter_id = self._current_iter_id
             duration = (time.time() - self._iter_started_at) * 1000
             self._current_iter_id = None
 
+            with self._condition:
+                self._set_data_events(iter_id)
+                # delete committed data
+                self._received_data = {k: v for k, v in
+                    self._received_data.items() if k[0] > iter_id}
+                self._data_events = {k: v for k, v in
+                    self._data_events.items() if k[0] > iter_id}
+
         with _gctx.stats_client.pipeline() as pipe:
             pipe.gauge("trainer.bridge.iterator_step", iter_id)
             pipe.timing("trainer.bridge.iterator_timing", duration)
@@ -405,10 +611,53 @@ class Bridge(object):
             "[Bridge] DataBlock handler already registered"
         self._data_block_handler_fn = func
 
+    def _data_block_stream_fn(self, request_queue):
+        request_iterator = iter(request_queue.get, _STREAM_END)
+        try:
+            for resp in self._client.LoadDataBlocks(request_iterator):
+                with self._data_block_lock:
+                    waiter = self._data_block_waiters.popleft()
+                waiter[1] = resp
+                waiter[0].set()
+            error = RuntimeError("[Bridge] LoadDataBlocks stream closed")
+        except Exception as e:  # pylint: disable=broad-except
+            fl_logging.error("[Bridge] LoadDataBlocks stream failed: %s",
+                             repr(e))
+            error = e
+
+        # fail requests sent on this stream, next load_data_block
+        # starts a new stream
+        with self._data_block_lock:
+            self._data_block_thread = None
+            self._data_block_queue = None
+            waiters = list(self._data_block_waiters)
+            self._data_block_waiters.clear()
+        for waiter in waiters:
+            waiter[1] = error
+            waiter[0].set()
+
+    def _load_data_block_stream(self, req):
+        waiter = [threading.Event(), None]
+        with self._data_block_lock:
+            if self._data_block_thread is None:
+                self._data_block_queue = queue.Queue()
+                self._data_block_thread = threading.Thread(
+                    target=self._data_block_stream_fn,
+                    args=(self._data_block_queue,))
+                self._data_block_thread.daemon = True
+                self._data_block_thread.start()
+            # enqueue under lock to keep waiters in request order
+            self._data_block_waiters.append(waiter)
+            self._data_block_queue.put(req)
+        waiter[0].wait()
+        if isinstance(waiter[1], Exception):
+            raise waiter[1]
+        return waiter[1]
+
     def load_data_block(self, count, block_id):
         req = tws2_pb.LoadDataBlockRequest(count=count, block_id=block_id)
         fl_logging.debug("[Bridge] sending DataBlock with id %s", block_id)
-        resp = self._client.LoadDataBlock(req)
+        resp = self._load_data_block_stream(req)
         if resp.status.code == common_pb.STATUS_SUCCESS:
             fl_logging.info("[Bridge] remote succeeded to load data block %s",
                             block_id)
@@ -417,22 +666,112 @@ class Bridge(object):
                            "code: %d", block_id, resp.status.code)
         return False
 
-    def _send(self, name, tensor=None, any_data=None):
-        with self._condition:
+    def _send(self, name, any_data=None, tensor_bytes=None, scale=None,
+              x=None):
+        # empty name marks a message carrying only start/commit flags
+        if not name:
+            raise ValueError("[Bridge] send with empty name")
+        with self._iter_lock:
             self._assert_iter_started()
 
-            self._transmit(tws2_pb.TransmitRequest(
-                data=tws2_pb.TransmitRequest.DataMessage(
-                    iter_id=self._current_iter_id,
-                    name=name,
-                    tensor=tensor,
-                    any_data=any_data,
-                )))
-            fl_logging.debug("[Bridge] Data: send iter_id: %d, name: %s",
-                self._current_iter_id, name)
+            if x is not None:
+                payload = x
+            elif tensor_bytes is not None:
+                payload = (tensor_bytes, scale)
+            else:
+                payload = any_data
+            self._transmit((self._current_iter_id, name,
+                            self._pending_start, False, payload))
+            self._pending_start = False
+            if fl_logging.is_debug_enabled():
+                fl_logging.debug("[Bridge] Data: send iter_id: %d, name: %s",
+                    self._current_iter_id, name)
+
+    def _serialize(self, x):
+        # serialize tensor in tf ops, float32 tensor is quantized by
+        # dtype_policy. return serialized tensor and scale, scale is 0
+        # if not quantized
+        x = tf.convert_to_tensor(x)
+        if self._dtype_policy == 'fp32' or x.dtype != tf.float32:
+            return tf.io.serialize_tensor(x), tf.constant(0.0)
+        if self._dtype_policy == 'bf16':
+            return tf.io.serialize_tensor(tf.cast(x, tf.bfloat16)), \
+                tf.constant(1.0)
+
+        def quantize():
+            max_abs = tf.reduce_max(tf.abs(x))
+            scale = tf.where(max_abs > 0, max_abs / 127.0, 1.0)
+            return tf.io.serialize_tensor(
+                tf.cast(tf.round(x / scale), tf.int8)), scale
+
+        def unquantized():
+            return tf.io.serialize_tensor(x), tf.constant(0.0)
+
+        # inf/nan can not be quantized to int8, send as float32
+        return tf.cond(tf.reduce_all(tf.math.is_finite(x)),
+                       quantize, unquantized)
+
+    def _parse(self, tensor_bytes, scale, dtype, name):
+        # parse tensor serialized by peer's _serialize in tf ops
+        dtype = tf.as_dtype(dtype)
+        wire_dtype = self._wire_dtype(dtype)
+        if wire_dtype == dtype:
+            return tf.io.parse_tensor(tensor_bytes, out_type=dtype,
+                                      name='parse_'+name)
+
+        def dequantize():
+            x = tf.io.parse_tensor(tensor_bytes, out_type=wire_dtype)
+            return tf.cast(x, dtype) * scale
+
+        def unquantized():
+            return tf.io.parse_tensor(tensor_bytes, out_type=dtype)
+
+        # scale is 0 if peer sent float32 unquantized
+        return tf.cond(tf.equal(scale, 0), unquantized, dequantize,
+                       name='parse_'+name)
+
+    def _quantize_ndarray(self, x):
+        # x is converted by _to_ndarray in send
+        if self._dtype_policy == 'fp32' or x.dtype != np.float32:
+            return x, 0.0
+        if self._dtype_policy == 'bf16':
+            return x.astype(tf.bfloat16.as_numpy_dtype), 1.0
+        max_abs = float(np.max(np.abs(x))) if x.size else 0.0
+        if not np.isfinite(max_abs):
+            # inf/nan can not be quantized to int8, send as float32
+            return x, 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        return np.round(x / scale).astype(np.int8), scale
+
+    def _wire_dtype(self, dtype):
+        dtype = tf.as_dtype(dtype)
+        if self._dtype_policy == 'fp32' or dtype != tf.float32:
+            return dtype
+        if self._dtype_policy == 'bf16':
+            return tf.bfloat16
+        return tf.int8
 
     def send(self, name, x):
-        self._send(name, tensor=tf.make_tensor_proto(x))
+        """Send tensor x to peer as name of current iteration.
+
+        A numpy array is serialized later in background, so it must not
+        be modified after send.
+        """
+        if isinstance(x, tf.Tensor) and tf.executing_eagerly():
+            # serialize in tf runtime, avoid copying out to numpy
+            tensor_bytes, scale = self._serialize(x)
+            tensor_bytes = tensor_bytes.numpy()
+            self._send(name, tensor_bytes=tensor_bytes, scale=float(scale))
+            return
+        x = _to_ndarray(x)
+        if x.dtype == np.object_:
+            # may be ragged or hold non bytes, serialize here to raise
+            # error in caller
+            self._send(name,
+                tensor_bytes=tf.make_tensor_proto(x).SerializeToString())
+        else:
+            # serialized later by stream transmit thread
+            self._send(name, x=x)
 
     def send_proto(self, name, proto):
         any_proto = any_pb.Any()
@@ -440,62 +779,168 @@ class Bridge(object):
         self._send(name, any_data=any_proto)
 
     def send_op(self, name, x):
-        def func(x):
-            self.send(name, x)
-
-        return tf.py_function(func=func, inp=[x], Tout=[], name='send_'+name)
+        def func(tensor_bytes, scale):
+            self._send(name, tensor_bytes=_as_bytes(tensor_bytes),
+                       scale=float(scale))
+
+        # serialize in graph, only enqueue is done under python
+        tensor_bytes, scale = self._serialize(x)
+        return tf.numpy_function(func=func,
+                                 inp=[tensor_bytes, scale],
+                                 Tout=[], name='send_'+name)
+
+    def send_ops(self, names, xs):
+        names, xs = list(names), list(xs)
+        if len(names) != len(xs):
+            raise ValueError(
+                "[Bridge] send_ops got {} names but {} tensors".format(
+                    len(names), len(xs)))
+
+        def func(*args):
+            # enqueue all tensors of the step together then flush, so
+            # they are sent in one batch without waiting batch window
+            with self._iter_lock:
+                for name, tensor_bytes, scale in \
+                    zip(names, args[0::2], args[1::2]):
+                    self._send(name, tensor_bytes=_as_bytes(tensor_bytes),
+                               scale=float(scale))
+            self.flush()
+
+        # one python call per step for all tensors
+        inp = []
+        for x in xs:
+            inp.extend(self._serialize(x))
+        return tf.numpy_function(func=func, inp=inp, Tout=[],
+                                 name='send_batch')
+
+    def _assert_receivable(self, iter_id, name):
+        self._assert_iter_started()
+        if iter_id != self._current_iter_id:
+            raise RuntimeError(
+                "[Bridge] iter change while waiting receive data, "
+                "iter_id: {}, name: {}".format(iter_id, name))
+        if self._peer_commit_iter_id is not None \
+            and iter_id <= self._peer_commit_iter_id:
+            raise RuntimeError(
+                "[Bridge] peer committed without sending data "
+                "iter_id: {}, name: {}".format(iter_id, name))
+        if self._peer_terminated:
+            raise RuntimeError(
+                "[Bridge] peer terminated without sending data "
+                "iter_id: {}, name: {}".format(iter_id, name))
 
     def _receive(self, name):
         start_time = time.time()
-        alert_count = 0
         with self._condition:
             self._assert_iter_started()
             iter_id = self._current_iter_id
-            while (iter_id not in self._received_data
-                   or name not in self._received_data[iter_id]):
-                self._assert_iter_started()
-                if iter_id != self._current_iter_id:
-                    raise RuntimeError(
-                        "[Bridge] iter change while waiting receive data, "
-                        "iter_id: {}, name: {}".format(iter_id, name))
-                if self._peer_commit_iter_id is not None \
-                    and iter_id <= self._peer_commit_iter_id:
-                    raise RuntimeError(
-                        "[Bridge] peer committed without sending data "
-                        "iter_id: {}, name: {}".format(iter_id, name))
-                if self._peer_terminated:
-                    raise RuntimeError(
-                        "[Bridge] peer terminated without sending data "
-                        "iter_id: {}, name: {}".format(iter_id, name))
-                duration = time.time() - start_time
-                if duration >= (alert_count+1)*self._waiting_alert_timeout:
-                    alert_count += 1
-                    fl_logging.warning("[Bridge] Data: waiting to receive "
-                        "iter_id: %d, name: %s timeout. duration: %f sec",
-                        iter_id, name, duration)
-                wait_timeout = self._waiting_alert_timeout - \
-                    (duration % self._waiting_alert_timeout)
-                self._condition.wait(wait_timeout)
-            data = self._received_data[iter_id][name]
+            key = (iter_id, name)
+            data = self._received_data.get(key)
+            if data is None:
+                self._assert_receivable(iter_id, name)
+                event = self._data_events.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._data_events[key] = event
+
+        if data is None:
+            # event is set on data arrival, or on any state change that
+            # makes it never arrive, so only wake up to alert
+            while not event.wait(self._waiting_alert_timeout):
+                fl_logging.warning("[Bridge] Data: waiting to receive "
+                    "iter_id: %d, name: %s timeout. duration: %f sec",
+                    iter_id, name, time.time() - start_time)
+            data = self._received_data.get(key)
+            if data is None:
+                self._assert_receivable(iter_id, name)
+                raise RuntimeError(
+                    "[Bridge] woken up without data "
+                    "iter_id: {}, name: {}".format(iter_id, name))
 
         duration = time.time() - start_time
         _gctx.stats_client.timing(
             "trainer.bridge.receive_timing", duration * 1000,
             {"bridge_receive_name": name}
         )
-        fl_logging.debug("[Bridge] Data: received iter_id: %d, name: %s "
-                         "after %f sec",
-                         iter_id, name, duration)
+        if fl_logging.is_debug_enabled():
+            fl_logging.debug("[Bridge] Data: received iter_id: %d, name: %s "
+                             "after %f sec",
+                             iter_id, name, duration)
         return data
 
     def receive(self, name):
-        return tf.make_ndarray(self._receive(name).tensor)
+        data = self._receive(name)
+        if not data.tensor_bytes:
+            return tf.make_ndarray(data.tensor)
+        x = tf.make_ndarray(tf.TensorProto.FromString(data.tensor_bytes))
+        if data.scale:
+            x = x.astype(np.float32) * np.float32(data.scale)
+        return x
+
+    def _receive_tensor_bytes(self, name):
+        data = self._receive(name)
+        if data.tensor_bytes:
+            return data.tensor_bytes, np.float32(data.scale)
+        return data.tensor.SerializeToString(), np.float32(0)
 
     def receive_proto(self, name):
         return self._receive(name).any_data
 
     def receive_op(self, name, dtype):
         def func():
-            return tf.convert_to_tensor(self.receive(name), dtype=dtype)
+            return self._receive_tensor_bytes(name)
+
+        # parse in graph, only dequeue is done under python
+        tensor_bytes, scale = tf.numpy_function(
+            func=func, inp=[], Tout=[tf.string, tf.float32],
+            name='recv_'+name)
+        return self._parse(tensor_bytes, scale, dtype, name)
 
-        return tf.py_function(func=func, inp=[], Tout=dtype, name='recv_'+name)
+    def receive_ops(self, names, dtypes):
+        names, dtypes = list(names), list(dtypes)
+        if len(names) != len(dtypes):
+            raise ValueError(
+                "[Bridge] receive_ops got {} names but {} dtypes".format(
+                    len(names), len(dtypes)))
+
+        def func():
+            outs = []
+            for name in names:
+                outs.extend(self._receive_tensor_bytes(name))
+            return outs
+
+        # one python call per step for all tensors
+        outs = tf.numpy_function(
+            func=func, inp=[], Tout=[tf.string, tf.float32] * len(names),
+            name='recv_batch')
+        return tuple(self._parse(tensor_bytes, scale, dtype, name)
+                     for name, dtype, tensor_bytes, scale in
+                     zip(names, dtypes, outs[0::2], outs[1::2]))
+
+
+def _to_ndarray(x):
+    # convert as make_tensor_proto does, so that bad input raises in
+    # caller instead of stream transmit thread
+    if isinstance(x, np.ndarray):
+        pass
+    elif isinstance(x, np.generic):
+        x = np.asarray(x)
+    else:
+        x = np.asarray(x)
+        # python float/int are float32/int32 in make_tensor_proto
+        if x.dtype == np.float64:
+            x = x.astype(np.float32)
+        elif x.dtype == np.int64:
+            downcast = x.astype(np.int32)
+            if np.array_equal(downcast, x):
+                x = downcast
+    # raise TypeError on unsupported dtype
+    tf.as_dtype(x.dtype)
+    return x
+
+
+def _as_bytes(x):
+    # numpy_function may pass a string scalar as 0-d object array
+    if isinstance(x, np.ndarray):
+        return x.item()
+    return x
@@ -18,6 +18,8 @@ import unittest
 import logging
 import threading
 import time
+import grpc
+import numpy as np
 from fedlearner.trainer import bridge
 import tensorflow.compat.v1 as tf
 
@@ -70,6 +72,253 @@ class TestBridge(unittest.TestCase):
         bridge2.terminate()
         t.join()
 
+    def test_bridge_quantize(self):
+        bridge1 = Bridge('leader', 49953, 'localhost:49954',
+                         dtype_policy='int8')
+        bridge2 = Bridge('follower', 49954, 'localhost:49953',
+                         dtype_policy='int8')
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        value = [1.0, -0.5, 0.25, 0.0]
+        # not quantizable, sent as float32
+        non_finite = [1.0, np.inf, np.nan, -0.5]
+        g1 = tf.Graph()
+        with g1.as_default():
+            send_x = bridge1.send_op('x', tf.constant(value))
+            send_w = bridge1.send_op('w', tf.constant(non_finite))
+
+        g2 = tf.Graph()
+        with g2.as_default():
+            recv_x = bridge2.receive_op('x', dtype=tf.float32)
+            recv_w = bridge2.receive_op('w', dtype=tf.float32)
+
+        bridge1.start()
+        bridge2.start()
+        with tf.Session(graph=g1) as sess:
+            sess.run([send_x, send_w])
+        bridge1.send('y', np.array(value, dtype=np.float32))
+        bridge1.send('v', np.array(non_finite, dtype=np.float32))
+        bridge1.send('z', value)
+        with tf.Session(graph=g2) as sess:
+            x, w = sess.run([recv_x, recv_w])
+        np.testing.assert_allclose(x, value, atol=1/127)
+        np.testing.assert_array_equal(w, np.array(non_finite, np.float32))
+        np.testing.assert_array_equal(bridge2.receive('v'),
+                                      np.array(non_finite, np.float32))
+        np.testing.assert_allclose(bridge2.receive('y'), value, atol=1/127)
+        z = bridge2.receive('z')
+        self.assertEqual(z.dtype, np.float32)
+        np.testing.assert_allclose(z, value, atol=1/127)
+        bridge1.commit()
+        bridge2.commit()
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+
+    def test_bridge_batch_ops(self):
+        bridge1 = Bridge('leader', 49957, 'localhost:49958')
+        bridge2 = Bridge('follower', 49958, 'localhost:49957')
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        g1 = tf.Graph()
+        with g1.as_default():
+            # names may be a one-shot iterator
+            send_xs = bridge1.send_ops(
+                iter(['x', 'y']), [tf.constant([1.0, 2.0]), tf.constant(3)])
+            with self.assertRaises(ValueError):
+                bridge1.send_ops(['x', 'y'], [tf.constant(1)])
+
+        g2 = tf.Graph()
+        with g2.as_default():
+            recv_x, recv_y = bridge2.receive_ops(
+                ['x', 'y'], [tf.float32, tf.int32])
+            with self.assertRaises(ValueError):
+                bridge2.receive_ops(['x'], [tf.float32, tf.int32])
+
+        bridge1.start()
+        bridge2.start()
+        with tf.Session(graph=g1) as sess:
+            sess.run(send_xs)
+        with tf.Session(graph=g2) as sess:
+            x, y = sess.run([recv_x, recv_y])
+        np.testing.assert_array_equal(x, [1.0, 2.0])
+        self.assertEqual(y, 3)
+        bridge1.commit()
+        bridge2.commit()
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+
+    def test_bridge_commit_without_send(self):
+        bridge1 = Bridge('leader', 49959, 'localhost:49960')
+        bridge2 = Bridge('follower', 49960, 'localhost:49959')
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        bridge1.start()
+        bridge2.start()
+        # empty name marks a start/commit only message
+        with self.assertRaises(ValueError):
+            bridge1.send('', np.zeros(1))
+        # start and commit go out in one message with empty name
+        bridge1.commit()
+        with self.assertRaisesRegex(RuntimeError,
+                                    'peer committed without sending data'):
+            bridge2.receive('x')
+        bridge2.commit()
+
+        # start, data and commit in one message are handled in order
+        bridge2._transmit_handler(tws_pb.TransmitRequest(
+            data=tws_pb.TransmitRequest.DataMessage(
+                iter_id=1, name='x',
+                tensor_bytes=tf.make_tensor_proto(
+                    np.array([1, 2], np.int32)).SerializeToString(),
+                start_flag=True, commit_flag=True)))
+        bridge2.start()
+        np.testing.assert_array_equal(bridge2.receive('x'), [1, 2])
+        bridge2.commit()
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+
+    def test_bridge_send_error(self):
+        bridge1 = Bridge('leader', 49961, 'localhost:49962')
+        bridge2 = Bridge('follower', 49962, 'localhost:49961')
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        bridge1.start()
+        bridge2.start()
+        # bad input raises in caller, not in stream transmit thread
+        with self.assertRaises((ValueError, TypeError)):
+            bridge1.send('ragged', [[1.0], [1.0, 2.0]])
+        # failed to serialize in stream transmit thread, the data is
+        # dropped but start flag still arrives and stream keeps going
+        bridge1._send('bad', x=np.array([object()], dtype=object))
+        bridge1.send('ok', np.array([1, 2], np.int32))
+        bridge1.commit()
+        np.testing.assert_array_equal(bridge2.receive('ok'), [1, 2])
+        with self.assertRaisesRegex(RuntimeError,
+                                    'peer committed without sending data'):
+            bridge2.receive('bad')
+        bridge2.commit()
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+
+    def _start_receive(self, bridge, name):
+        # receive in a thread, returns the thread and its error holder
+        errors = []
+        def fn():
+            try:
+                bridge.receive(name)
+            except RuntimeError as e:
+                errors.append(e)
+        t = threading.Thread(target=fn)
+        t.daemon = True
+        t.start()
+        # let it block on waiting for data
+        time.sleep(0.5)
+        self.assertTrue(t.is_alive())
+        return t, errors
+
+    def _assert_receive_error(self, t, errors, regex):
+        t.join(10)
+        self.assertFalse(t.is_alive(), 'receive still blocked')
+        self.assertEqual(len(errors), 1)
+        self.assertRegex(str(errors[0]), regex)
+
+    def test_bridge_receive_wakeup(self):
+        bridge1 = Bridge('leader', 49963, 'localhost:49964')
+        bridge2 = Bridge('follower', 49964, 'localhost:49963')
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        # local commit
+        bridge1.start()
+        bridge2.start()
+        t, errors = self._start_receive(bridge2, 'x')
+        bridge2.commit()
+        self._assert_receive_error(t, errors, 'not started yet')
+        bridge1.commit()
+
+        # peer commits without sending
+        bridge1.start()
+        bridge2.start()
+        t, errors = self._start_receive(bridge2, 'x')
+        bridge1.commit()
+        self._assert_receive_error(t, errors,
+                                   'peer committed without sending data')
+        bridge2.commit()
+
+        # peer terminates
+        bridge2.start()
+        t, errors = self._start_receive(bridge2, 'x')
+        t1 = threading.Thread(target=lambda _: bridge1.terminate(),
+                              args=(None,))
+        t1.start()
+        self._assert_receive_error(t, errors,
+                                   'peer terminated without sending data')
+        bridge2.terminate()
+        t1.join()
+
+    def test_load_data_block(self):
+        bridge1 = Bridge('leader', 49955, 'localhost:49956')
+        bridge2 = Bridge('follower', 49956, 'localhost:49955')
+        loaded = []
+        def handler(req):
+            if req.block_id == 'error':
+                raise RuntimeError('failed to load ' + req.block_id)
+            loaded.append((req.count, req.block_id))
+            return req.block_id != 'invalid'
+        bridge2.register_data_block_handler(handler)
+
+        t = threading.Thread(target=lambda _: bridge1.connect(), args=(None,))
+        t.start()
+        bridge2.connect()
+        t.join()
+
+        self.assertTrue(bridge1.load_data_block(0, 'block_0'))
+        self.assertFalse(bridge1.load_data_block(1, 'invalid'))
+        self.assertTrue(bridge1.load_data_block(1, 'block_1'))
+        self.assertEqual(loaded,
+            [(0, 'block_0'), (1, 'invalid'), (1, 'block_1')])
+        # handler error reaches the caller, and the stream restarts
+        with self.assertRaises(grpc.RpcError):
+            bridge1.load_data_block(2, 'error')
+        self.assertTrue(bridge1.load_data_block(2, 'block_2'))
+        self.assertEqual(loaded[-1], (2, 'block_2'))
+
+        t = threading.Thread(target=lambda _: bridge1.terminate(), args=(None,))
+        t.start()
+        bridge2.terminate()
+        t.join()
+
 if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
         unittest.main()